@@ -1,18 +1,27 @@
 import os
+import hmac
 import json
+import time
+import struct
+import sqlite3
 import pyotp
-import qrcode
+import segno
 import logging
 from io import BytesIO
-from base64 import b64encode
+from base64 import b64encode, b32decode
 from datetime import timedelta
 from functools import wraps
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_wtf.csrf import CSRFProtect
+from sqlalchemy import String, event, insert, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import joinedload
 from dotenv import load_dotenv
 import bcrypt
 
@@ -43,10 +52,21 @@ app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(
 app.config['SESSION_COOKIE_HTTPONLY'] = os.getenv('SESSION_COOKIE_HTTPONLY', 'True').lower() == 'true'
 app.config['SESSION_COOKIE_SECURE'] = os.getenv('SESSION_COOKIE_SECURE', 'False').lower() == 'true'
 app.config['SESSION_COOKIE_SAMESITE'] = os.getenv('SESSION_COOKIE_SAMESITE', 'Lax')
+app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'SimpleCache')
+app.config['CACHE_DEFAULT_TIMEOUT'] = int(os.getenv('CACHE_DEFAULT_TIMEOUT', 300))
+app.config['BCRYPT_COST'] = int(os.getenv('BCRYPT_COST', 12))
+if not 4 <= app.config['BCRYPT_COST'] <= 31:
+    logger.warning(f'BCRYPT_COST {app.config["BCRYPT_COST"]} is outside 4-31, using 12')
+    app.config['BCRYPT_COST'] = 12
+app.config['PREFERRED_URL_SCHEME'] = os.getenv(
+    'PREFERRED_URL_SCHEME', 'https' if os.getenv('FLASK_ENV') == 'production' else 'http'
+)
+app.json.sort_keys = False
 
 # Initialize extensions
 db = SQLAlchemy(app)
 csrf = CSRFProtect(app)
+cache = Cache(app)
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
@@ -54,12 +74,25 @@ limiter = Limiter(
     storage_uri=os.getenv('RATELIMIT_STORAGE_URL', 'memory://')
 )
 
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Use WAL journaling so token writes don't block readers"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
 # Database Models
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(255), nullable=False)
+    username = db.Column(db.String(80), unique=True, index=True, nullable=False)
+    password = db.Column(db.LargeBinary(60), nullable=False)
     secret = db.Column(db.String(32), nullable=False)
+    secret_raw = db.Column(db.LargeBinary)
     tokens = db.relationship('Token', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def __repr__(self):
@@ -70,13 +103,69 @@ class Token(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     service = db.Column(db.String(100), nullable=False)
     secret = db.Column(db.String(32), nullable=False)
+    secret_raw = db.Column(db.LargeBinary)
 
     def __repr__(self):
         return f'<Token {self.service}>'
 
+def column_type(table, column):
+    """Return the reflected type of a column as it exists in the database"""
+    for reflected in inspect(db.engine).get_columns(table):
+        if reflected['name'] == column:
+            return reflected['type']
+    return None
+
+def apply_schema_change(statement, is_applied):
+    """Run a DDL statement, tolerating another worker having applied it first"""
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(text(statement))
+    except DBAPIError:
+        if not is_applied():
+            raise
+        return False
+    return True
+
+def upgrade_schema():
+    """Bring tables created by older versions of the app up to date"""
+    dialect = db.engine.dialect.name
+
+    # Password hashes moved from text to binary; SQLite's loose typing needs
+    # no conversion because check_password also accepts legacy str hashes
+    def password_is_text():
+        return isinstance(column_type('user', 'password'), String)
+
+    if dialect == 'postgresql' and password_is_text():
+        if apply_schema_change(
+            'ALTER TABLE "user" ALTER COLUMN password TYPE BYTEA '
+            "USING convert_to(password, 'UTF8')",
+            lambda: not password_is_text()
+        ):
+            logger.info('Converted user.password column to binary')
+    elif dialect in ('mysql', 'mariadb') and password_is_text():
+        if apply_schema_change(
+            'ALTER TABLE `user` MODIFY password VARBINARY(60) NOT NULL',
+            lambda: not password_is_text()
+        ):
+            logger.info('Converted user.password column to binary')
+    elif dialect != 'sqlite' and password_is_text():
+        logger.warning(f'Cannot convert user.password to binary on {dialect}; migrate it manually')
+
+    # Decoded TOTP keys stored alongside the base32 secrets
+    for table in (User.__table__, Token.__table__):
+        if column_type(table.name, 'secret_raw') is None:
+            table_name = db.engine.dialect.identifier_preparer.quote(table.name)
+            binary_type = table.c.secret_raw.type.compile(dialect=db.engine.dialect)
+            if apply_schema_change(
+                f'ALTER TABLE {table_name} ADD COLUMN secret_raw {binary_type}',
+                lambda: column_type(table.name, 'secret_raw') is not None
+            ):
+                logger.info(f'Added secret_raw column to {table.name} table')
+
 # Create tables
 with app.app_context():
     db.create_all()
+    upgrade_schema()
 
 # Helper Functions
 def login_required(f):
@@ -114,8 +203,71 @@ def sanitize_service_name(service):
     """Sanitize service name input"""
     return ''.join(char for char in service if char.isalnum() or char in ' -_').strip()[:100]
 
+def decode_secret(secret):
+    """Decode a base32 TOTP secret into raw HMAC key bytes"""
+    return b32decode(secret + '=' * (-len(secret) % 8), casefold=True)
+
+def truncate_digest(digest):
+    """Dynamically truncate an HMAC-SHA1 digest into a 6-digit code"""
+    offset = digest[-1] & 0x0f
+    code = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7fffffff
+    return f'{code % 1000000:06d}'
+
+def totp_at(key, counter):
+    """Compute the 6-digit TOTP code for a raw key at a given time step"""
+    return truncate_digest(hmac.digest(key, struct.pack('>Q', counter), 'sha1'))
+
+def verify_totp(key, code, window=1):
+    """Check a code against the current time step +/- window in constant time"""
+    counter = int(time.time()) // 30
+    code = code.encode('utf-8')
+    valid = False
+    for step in range(counter - window, counter + window + 1):
+        valid |= hmac.compare_digest(totp_at(key, step).encode('ascii'), code)
+    return valid
+
+def batch_totp_now(keys):
+    """Compute the current 6-digit TOTP codes for a list of raw keys"""
+    # hmac.digest runs the whole HMAC-SHA1 in OpenSSL, so the Python side
+    # is just the shared counter and the truncation
+    counter = struct.pack('>Q', int(time.time()) // 30)
+    return [truncate_digest(hmac.digest(key, counter, 'sha1')) for key in keys]
+
+def generate_qr_uri(username, secret):
+    """Render the provisioning URI QR code as a PNG data: URI"""
+    totp_uri = pyotp.totp.TOTP(secret).provisioning_uri(
+        name=username,
+        issuer_name='2FA-App'
+    )
+    buffered = BytesIO()
+    segno.make(totp_uri, error='m').save(buffered, kind='png', scale=10)
+    return 'data:image/png;base64,' + b64encode(buffered.getbuffer()).decode('ascii')
+
+def hash_password(password):
+    """Hash a password with bcrypt ($2b$ format)"""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(app.config['BCRYPT_COST']))
+
+def check_password(password, hashed):
+    """Check a password against a stored bcrypt hash in constant time"""
+    # Hashes stored before the column became binary are read back as str
+    if isinstance(hashed, str):
+        hashed = hashed.encode('ascii')
+    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+
+# Checked against on unknown usernames so failed logins take the same time
+DUMMY_PASSWORD_HASH = hash_password(os.urandom(16).hex())
+
+def is_post_request():
+    """Skip view caching for form submissions"""
+    return request.method == 'POST'
+
+def is_logged_in():
+    """Skip view caching for logged-in users, who get redirected"""
+    return 'user_id' in session
+
 # Routes
 @app.route('/')
+@cache.cached(timeout=3600, key_prefix='view/%s', unless=is_logged_in)
 def home():
     if 'user_id' in session:
         return redirect(url_for('dashboard'))
@@ -123,6 +275,7 @@ def home():
 
 @app.route('/register', methods=['GET', 'POST'])
 @limiter.limit("5 per hour")
+@cache.cached(timeout=3600, key_prefix='view/%s', unless=is_post_request)
 def register():
     if request.method == 'POST':
         try:
@@ -142,19 +295,20 @@ def register():
                 return render_template('register.html', error=message)
 
             # Check if user exists
-            if User.query.filter_by(username=username).first():
+            if db.session.scalars(select(User).filter_by(username=username)).first():
                 logger.warning(f'Registration failed: Username {username} already exists')
                 return render_template('register.html', error='Username already exists')
 
             # Hash password and create secret
-            hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+            hashed_password = hash_password(password)
             secret = pyotp.random_base32()
 
             # Create new user
             new_user = User(
                 username=username,
-                password=hashed_password.decode('utf-8'),
-                secret=secret
+                password=hashed_password,
+                secret=secret,
+                secret_raw=decode_secret(secret)
             )
             db.session.add(new_user)
             db.session.commit()
@@ -162,15 +316,7 @@ def register():
             logger.info(f'New user registered: {username}')
 
             # Generate QR code
-            totp_uri = pyotp.totp.TOTP(secret).provisioning_uri(
-                name=username,
-                issuer_name='2FA-App'
-            )
-            
-            img = qrcode.make(totp_uri)
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            qr_code = b64encode(buffered.getvalue()).decode('utf-8')
+            qr_code = generate_qr_uri(username, secret)
 
             session['temp_user_id'] = new_user.id
             return render_template('qr.html', qr_code=qr_code, username=username)
@@ -195,12 +341,11 @@ def verify():
         if not code.isdigit() or len(code) != 6:
             return render_template('verify.html', error='Invalid code format')
 
-        user = User.query.get(user_id)
+        user = db.session.get(User, user_id)
         if not user:
             return redirect(url_for('login'))
 
-        totp = pyotp.TOTP(user.secret)
-        if totp.verify(code, valid_window=1):
+        if verify_totp(user.secret_raw or decode_secret(user.secret), code):
             session.pop('temp_user_id', None)
             session['user_id'] = user.id
             session.permanent = True
@@ -216,6 +361,7 @@ def verify():
 
 @app.route('/login', methods=['GET', 'POST'])
 @limiter.limit("10 per minute")
+@cache.cached(timeout=3600, key_prefix='view/%s', unless=is_post_request)
 def login():
     if request.method == 'POST':
         try:
@@ -229,14 +375,19 @@ def login():
             if not code.isdigit() or len(code) != 6:
                 return render_template('login.html', error='Invalid code format')
 
-            user = User.query.filter_by(username=username).first()
+            user = db.session.scalars(select(User).filter_by(username=username)).first()
             
-            if not user or not bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
+            if user:
+                password_valid = check_password(password, user.password)
+            else:
+                check_password(password, DUMMY_PASSWORD_HASH)
+                password_valid = False
+
+            if not password_valid:
                 logger.warning(f'Failed login attempt for username: {username}')
                 return render_template('login.html', error='Invalid credentials')
 
-            totp = pyotp.TOTP(user.secret)
-            if totp.verify(code, valid_window=1):
+            if verify_totp(user.secret_raw or decode_secret(user.secret), code):
                 session['user_id'] = user.id
                 session.permanent = True
                 logger.info(f'User logged in: {username}')
@@ -255,16 +406,21 @@ def login():
 @login_required
 def dashboard():
     try:
-        user = User.query.get(session['user_id'])
-        tokens = Token.query.filter_by(user_id=user.id).all()
+        # Load the user and their tokens in a single round trip
+        user = db.session.scalars(
+            select(User).options(joinedload(User.tokens)).filter_by(id=session['user_id'])
+        ).unique().one()
+        tokens = user.tokens
         
+        codes = batch_totp_now([
+            token.secret_raw or decode_secret(token.secret) for token in tokens
+        ])
         token_data = []
-        for token in tokens:
-            totp = pyotp.TOTP(token.secret)
+        for token, code in zip(tokens, codes):
             token_data.append({
                 'id': token.id,
                 'service': token.service,
-                'code': totp.now()
+                'code': code
             })
         
         return render_template('dashboard.html', username=user.username, tokens=token_data)
@@ -289,10 +445,10 @@ def add_token():
                 return render_template('addToken.html', error='Invalid service name')
 
             # Check for duplicate service names
-            existing = Token.query.filter_by(
+            existing = db.session.scalars(select(Token).filter_by(
                 user_id=session['user_id'],
                 service=service
-            ).first()
+            )).first()
             
             if existing:
                 return render_template('addToken.html', error='Token for this service already exists')
@@ -301,7 +457,8 @@ def add_token():
             new_token = Token(
                 user_id=session['user_id'],
                 service=service,
-                secret=secret
+                secret=secret,
+                secret_raw=decode_secret(secret)
             )
             db.session.add(new_token)
             db.session.commit()
@@ -321,7 +478,7 @@ def add_token():
 @limiter.limit("30 per hour")
 def delete_token(token_id):
     try:
-        token = Token.query.get_or_404(token_id)
+        token = db.get_or_404(Token, token_id)
         
         if token.user_id != session['user_id']:
             logger.warning(f'Unauthorized token deletion attempt by user_id: {session["user_id"]}')
@@ -344,18 +501,22 @@ def delete_token(token_id):
 @limiter.limit("10 per hour")
 def export_tokens():
     try:
-        tokens = Token.query.filter_by(user_id=session['user_id']).all()
+        rows = db.session.execute(
+            select(Token.service, Token.secret).filter_by(user_id=session['user_id'])
+        )
         export_data = {
             'tokens': [
-                {'service': token.service, 'secret': token.secret}
-                for token in tokens
+                {'service': service, 'secret': secret}
+                for service, secret in rows
             ]
         }
-        
-        user = User.query.get(session['user_id'])
-        logger.info(f'Tokens exported by user: {user.username}')
-        
-        return jsonify(export_data)
+
+        logger.info(f'Tokens exported by user_id: {session["user_id"]}')
+
+        return app.response_class(
+            json.dumps(export_data, separators=(',', ':'), ensure_ascii=False),
+            mimetype='application/json'
+        )
 
     except Exception as e:
         logger.error(f'Export tokens error: {str(e)}')
@@ -377,7 +538,12 @@ def import_token():
             if 'tokens' not in data or not isinstance(data['tokens'], list):
                 return render_template('importToken.html', error='Invalid file format')
 
-            imported_count = 0
+            # Fetch existing service names once instead of querying per token
+            existing = set(db.session.scalars(
+                select(Token.service).filter_by(user_id=session['user_id'])
+            ))
+
+            new_tokens = []
             for token_data in data['tokens']:
                 service = sanitize_service_name(token_data.get('service', ''))
                 secret = token_data.get('secret', '')
@@ -386,24 +552,26 @@ def import_token():
                     continue
 
                 # Skip if token already exists
-                existing = Token.query.filter_by(
-                    user_id=session['user_id'],
-                    service=service
-                ).first()
-                
-                if existing:
+                if service in existing:
+                    continue
+
+                try:
+                    secret_raw = decode_secret(secret)
+                except (TypeError, ValueError):
                     continue
 
-                new_token = Token(
-                    user_id=session['user_id'],
-                    service=service,
-                    secret=secret
-                )
-                db.session.add(new_token)
-                imported_count += 1
+                existing.add(service)
+                new_tokens.append({
+                    'user_id': session['user_id'],
+                    'service': service,
+                    'secret': secret,
+                    'secret_raw': secret_raw
+                })
 
+            if new_tokens:
+                db.session.execute(insert(Token), new_tokens)
             db.session.commit()
-            logger.info(f'{imported_count} tokens imported by user_id: {session["user_id"]}')
+            logger.info(f'{len(new_tokens)} tokens imported by user_id: {session["user_id"]}')
             
             return redirect(url_for('dashboard'))
 
@@ -431,7 +599,7 @@ def health():
     """Health check endpoint"""
     try:
         # Check database connection
-        db.session.execute('SELECT 1')
+        db.session.execute(text('SELECT 1'))
         return jsonify({'status': 'healthy', 'database': 'connected'}), 200
     except Exception as e:
         logger.error(f'Health check failed: {str(e)}')
@@ -453,5 +621,6 @@ def internal_error(e):
     return "An internal error occurred. Please try again later.", 500
 
 if __name__ == '__main__':
-    debug_mode = os.getenv('FLASK_DEBUG', 'True').lower() == 'true'
+    # Development server only; production runs under gunicorn (gunicorn.conf.py)
+    debug_mode = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
     app.run(debug=debug_mode, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""Gunicorn configuration for production deployments"""
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Each worker keeps its own rate-limit counters while RATELIMIT_STORAGE_URL
+# is memory://, so the effective limits scale with the worker count. Keep
+# this small, or point RATELIMIT_STORAGE_URL at shared storage (e.g. Redis)
+# before raising GUNICORN_WORKERS.
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+
+# bcrypt releases the GIL while hashing, so threaded workers keep serving
+# other requests while a registration or login is being hashed
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+timeout = 120